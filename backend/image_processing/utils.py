@@ -1,18 +1,33 @@
 import base64
 import io
+import re
 import time
 from PIL import Image
 
 CLAUDE_IMAGE_MAX_SIZE = 5 * 1024 * 1024
 CLAUDE_MAX_IMAGE_DIMENSION = 7990
 
+# Matches the prefix of a base64 data URL, e.g. data:image/png;base64,iVBOR...
+# Splitting the URL three times scans (and copies) the multi-MB payload each
+# time; matching the short prefix and slicing once does a single tail copy.
+DATA_URL_REGEX = re.compile(r"^data:([^;]+);base64,")
+
+
+# Length of base64(data) computed arithmetically (4 chars per 3-byte block),
+# so size checks don't have to encode (and copy) the whole image
+def base64_encoded_len(num_bytes: int) -> int:
+    return (num_bytes + 2) // 3 * 4
+
 
 # Process image so it meets Claude requirements
 def process_image(image_data_url: str) -> tuple[str, str]:
 
     # Extract bytes and media type from base64 data URL
-    media_type = image_data_url.split(";")[0].split(":")[1]
-    base64_data = image_data_url.split(",")[1]
+    match = DATA_URL_REGEX.match(image_data_url)
+    if not match:
+        raise ValueError("Invalid base64 data URL")
+    media_type = match.group(1)
+    base64_data = image_data_url[match.end() :]
     image_bytes = base64.b64decode(base64_data)
 
     img = Image.open(io.BytesIO(image_bytes))
@@ -59,16 +74,19 @@ def process_image(image_data_url: str) -> tuple[str, str]:
 
     # Reduce quality until image is under max size
     while (
-        len(base64.b64encode(output.getvalue())) > CLAUDE_IMAGE_MAX_SIZE
+        base64_encoded_len(output.getbuffer().nbytes) > CLAUDE_IMAGE_MAX_SIZE
         and quality > 10
     ):
         output = io.BytesIO()
         img.save(output, format="JPEG", quality=quality)
         quality -= 5
 
+    # Encode only the final result, once
+    processed_base64_data = base64.b64encode(output.getvalue()).decode("utf-8")
+
     # Log so we know it was modified
     old_size = len(base64_data)
-    new_size = len(base64.b64encode(output.getvalue()))
+    new_size = len(processed_base64_data)
     print(
         f"[CLAUDE IMAGE PROCESSING] image size updated: old size = {old_size} bytes, new size = {new_size} bytes"
     )
@@ -77,4 +95,4 @@ def process_image(image_data_url: str) -> tuple[str, str]:
     processing_time = end_time - start_time
     print(f"[CLAUDE IMAGE PROCESSING] processing time: {processing_time:.2f} seconds")
 
-    return ("image/jpeg", base64.b64encode(output.getvalue()).decode("utf-8"))
+    return ("image/jpeg", processed_base64_data)
@@ -1,6 +1,10 @@
+import asyncio
 import copy
+import time
+import traceback
 from enum import Enum
 from typing import Any, Awaitable, Callable, List, cast
+import httpx
 from anthropic import AsyncAnthropic
 from openai import AsyncOpenAI
 from openai.types.chat import ChatCompletionMessageParam, ChatCompletionChunk
@@ -23,77 +27,247 @@ class Llm(Enum):
     CLAUDE_3_5_SONNET_2024_10_22 = "claude-3-5-sonnet-20241022"
 
 
+# Frontend model strings (including legacy aliases) to Llm members,
+# precomputed once so conversion is a single dict lookup per session
+_FRONTEND_TO_LLM: dict[str, Llm] = {
+    "gpt_4_vision": Llm.GPT_4_VISION,
+    "claude_3_sonnet": Llm.CLAUDE_3_SONNET,
+    **{model.value: model for model in Llm},
+}
+
+
 # Will throw errors if you send a garbage string
 def convert_frontend_str_to_llm(frontend_str: str) -> Llm:
-    if frontend_str == "gpt_4_vision":
-        return Llm.GPT_4_VISION
-    elif frontend_str == "claude_3_sonnet":
-        return Llm.CLAUDE_3_SONNET
+    try:
+        return _FRONTEND_TO_LLM[frontend_str]
+    except KeyError:
+        raise ValueError(f"{frontend_str} is not a valid Llm")
+
+
+# Pooled API clients, keyed by credentials. Creating a new client per request
+# tears down the underlying HTTP connection pool after one use, so every
+# generation would pay for a fresh DNS lookup + TCP + TLS handshake. Reusing
+# clients keeps connections warm across generations.
+#
+# API keys arrive from the frontend settings dialog, so the pools are kept as
+# small LRUs — an unbounded dict would pin a connection pool forever for every
+# unique (including garbage) key a client ever sent.
+_CLIENT_POOL_MAX_SIZE = 4
+_openai_clients: dict[tuple[str, str | None], AsyncOpenAI] = {}
+_anthropic_clients: dict[str, AsyncAnthropic] = {}
+
+# Keep references to in-flight close() tasks so they aren't garbage collected
+_client_close_tasks: set["asyncio.Task[Any]"] = set()
+
+# In-flight stream counts per pooled client, keyed by id() (stable here: the
+# pool, the pending-close table or the stream function itself holds a strong
+# reference for as long as an entry exists). A client evicted from the LRU
+# while another session is still streaming on it must not be closed under
+# that session — it is parked in _clients_pending_close and closed only when
+# its last stream releases it.
+_client_in_flight: dict[int, int] = {}
+_clients_pending_close: dict[int, AsyncOpenAI | AsyncAnthropic] = {}
+
+
+def _close_client_in_background(client: AsyncOpenAI | AsyncAnthropic) -> None:
+    task = asyncio.create_task(client.close())
+    _client_close_tasks.add(task)
+    task.add_done_callback(_client_close_tasks.discard)
+
+
+def _retire_client(client: AsyncOpenAI | AsyncAnthropic) -> None:
+    # Called on LRU eviction: close right away only if the client is idle,
+    # otherwise defer the close until its last in-flight stream finishes
+    if _client_in_flight.get(id(client), 0) > 0:
+        _clients_pending_close[id(client)] = client
     else:
-        return Llm(frontend_str)
-
-
-async def stream_openai_response(
-    messages: List[ChatCompletionMessageParam],
-    api_key: str,
-    base_url: str | None,
-    callback: Callable[[str], Awaitable[None]],
-    model: Llm,
-) -> str:
-    client = AsyncOpenAI(api_key=api_key, base_url=base_url)
-
-    # Base parameters
-    params = {
-        "model": model.value,
-        "messages": messages,
-        "stream": True,
-        "timeout": 600,
-        "temperature": 0.0,
-    }
-
-    # Add 'max_tokens' only if the model is a GPT4 vision or Turbo model
-    if (
-        model == Llm.GPT_4_VISION
-        or model == Llm.GPT_4_TURBO_2024_04_09
-        or model == Llm.GPT_4O_2024_05_13
+        _close_client_in_background(client)
+
+
+def _release_client(client: AsyncOpenAI | AsyncAnthropic) -> None:
+    key = id(client)
+    count = _client_in_flight.get(key, 0) - 1
+    if count > 0:
+        _client_in_flight[key] = count
+        return
+    _client_in_flight.pop(key, None)
+    evicted = _clients_pending_close.pop(key, None)
+    if evicted is not None:
+        _close_client_in_background(evicted)
+
+
+# The get_* helpers check the client out for one stream: callers must call
+# _release_client in a finally block once they are done with it.
+def get_openai_client(api_key: str, base_url: str | None) -> AsyncOpenAI:
+    key = (api_key, base_url)
+    client = _openai_clients.pop(key, None)
+    if client is None:
+        if len(_openai_clients) >= _CLIENT_POOL_MAX_SIZE:
+            _retire_client(_openai_clients.pop(next(iter(_openai_clients))))
+        client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+            ),
+        )
+    # Re-insert so dict order doubles as least-recently-used order
+    _openai_clients[key] = client
+    _client_in_flight[id(client)] = _client_in_flight.get(id(client), 0) + 1
+    return client
+
+
+def get_anthropic_client(api_key: str) -> AsyncAnthropic:
+    client = _anthropic_clients.pop(api_key, None)
+    if client is None:
+        if len(_anthropic_clients) >= _CLIENT_POOL_MAX_SIZE:
+            _retire_client(_anthropic_clients.pop(next(iter(_anthropic_clients))))
+        client = AsyncAnthropic(api_key=api_key)
+    _anthropic_clients[api_key] = client
+    _client_in_flight[id(client)] = _client_in_flight.get(id(client), 0) + 1
+    return client
+
+
+class _CallbackCoalescer:
+    """Batches streamed chunks before dispatching them to the callback.
+
+    Invoking the callback once per token costs an event-loop hop (and, for the
+    websocket route, one JSON message) per token. Accumulating a few chunks and
+    flushing on a short time window cuts that overhead without any visible
+    difference in streaming smoothness.
+    """
+
+    def __init__(
+        self,
+        callback: Callable[[str], Awaitable[None]],
+        max_chunks: int = 4,
+        max_interval: float = 0.02,
     ):
-        params["max_tokens"] = 4096
-
-    stream = await client.chat.completions.create(**params)  # type: ignore
-    full_response = ""
-    async for chunk in stream:  # type: ignore
-        assert isinstance(chunk, ChatCompletionChunk)
+        self.callback = callback
+        self.max_chunks = max_chunks
+        self.max_interval = max_interval
+        self.buffer: list[str] = []
+        self.last_flush = time.monotonic()
+
+    async def add(self, content: str) -> None:
+        self.buffer.append(content)
         if (
-            chunk.choices
-            and len(chunk.choices) > 0
-            and chunk.choices[0].delta
-            and chunk.choices[0].delta.content
+            len(self.buffer) >= self.max_chunks
+            or time.monotonic() - self.last_flush > self.max_interval
         ):
-            content = chunk.choices[0].delta.content or ""
-            full_response += content
-            await callback(content)
+            await self.flush()
 
-    await client.close()
+    async def flush(self) -> None:
+        if self.buffer:
+            await self.callback("".join(self.buffer))
+            self.buffer.clear()
+        self.last_flush = time.monotonic()
 
-    return full_response
 
+# Called from the FastAPI shutdown hook so we don't leak connections on exit
+async def close_all_clients() -> None:
+    for client in list(_openai_clients.values()):
+        await client.close()
+    for anthropic_client in list(_anthropic_clients.values()):
+        await anthropic_client.close()
+    for pending_client in list(_clients_pending_close.values()):
+        await pending_client.close()
+    _openai_clients.clear()
+    _anthropic_clients.clear()
+    _clients_pending_close.clear()
+    _client_in_flight.clear()
 
-# TODO: Have a seperate function that translates OpenAI messages to Claude messages
-async def stream_claude_response(
+
+async def stream_openai_response(
     messages: List[ChatCompletionMessageParam],
     api_key: str,
+    base_url: str | None,
     callback: Callable[[str], Awaitable[None]],
     model: Llm,
 ) -> str:
-
-    client = AsyncAnthropic(api_key=api_key)
-
-    # Base parameters
-    max_tokens = 8192
-    temperature = 0.0
-
-    # Translate OpenAI messages to Claude messages
-
+    client = get_openai_client(api_key, base_url)
+    try:
+        # Base parameters
+        params = {
+            "model": model.value,
+            "messages": messages,
+            "stream": True,
+            "timeout": 600,
+            "temperature": 0.0,
+        }
+
+        # Add 'max_tokens' only if the model is a GPT4 vision or Turbo model
+        if (
+            model == Llm.GPT_4_VISION
+            or model == Llm.GPT_4_TURBO_2024_04_09
+            or model == Llm.GPT_4O_2024_05_13
+        ):
+            params["max_tokens"] = 4096
+
+        stream = await client.chat.completions.create(**params)  # type: ignore
+        # Collect chunks in a list and join once at the end — growing a str
+        # with += copies the whole accumulated response on every token
+        response_parts: list[str] = []
+        coalescer = _CallbackCoalescer(callback)
+        async for chunk in stream:  # type: ignore
+            assert isinstance(chunk, ChatCompletionChunk)
+            if (
+                chunk.choices
+                and len(chunk.choices) > 0
+                and chunk.choices[0].delta
+                and chunk.choices[0].delta.content
+            ):
+                content = chunk.choices[0].delta.content or ""
+                response_parts.append(content)
+                await coalescer.add(content)
+        await coalescer.flush()
+
+        return "".join(response_parts)
+    finally:
+        _release_client(client)
+
+
+# Translated prompts cached by the identity of the source message list. The
+# websocket route runs up to two Claude variants off the same prompt list, and
+# retries reuse it too — translating (and re-processing the images) once is
+# enough. Entries hold a strong reference to the source list so its id cannot
+# be recycled while the entry is alive; the cache stays small to bound that.
+_TRANSLATED_CACHE_MAX_SIZE = 4
+_translated_cache: dict[
+    int,
+    tuple[
+        List[ChatCompletionMessageParam],
+        "asyncio.Future[tuple[str, list[dict[str, Any]]]]",
+    ],
+] = {}
+
+
+# Translate OpenAI-style messages (system message + image_url content blocks)
+# into a Claude system prompt + messages with base64 image sources.
+# Memoized per source list; concurrent callers share a single translation.
+async def translate_openai_to_claude(
+    messages: List[ChatCompletionMessageParam],
+) -> tuple[str, list[dict[str, Any]]]:
+    key = id(messages)
+    cached = _translated_cache.get(key)
+    if cached is None or cached[0] is not messages:
+        if len(_translated_cache) >= _TRANSLATED_CACHE_MAX_SIZE:
+            _translated_cache.pop(next(iter(_translated_cache)))
+        future = asyncio.ensure_future(_translate_openai_to_claude(messages))
+        _translated_cache[key] = (messages, future)
+        cached = (messages, future)
+
+    try:
+        return await cached[1]
+    except Exception:
+        # Don't cache failures (e.g. an unprocessable image)
+        _translated_cache.pop(key, None)
+        raise
+
+
+async def _translate_openai_to_claude(
+    messages: List[ChatCompletionMessageParam],
+) -> tuple[str, list[dict[str, Any]]]:
     # Deep copy messages to avoid modifying the original list
     cloned_messages = copy.deepcopy(messages)
 
@@ -113,7 +287,11 @@ async def stream_claude_response(
 
                 # Process image and split media type and data
                 # so it works with Claude (under 5mb in base64 encoding)
-                (media_type, base64_data) = process_image(image_data_url)
+                # Run in a thread: resizing/recompressing large images with PIL
+                # would otherwise block the event loop for other sessions
+                (media_type, base64_data) = await asyncio.to_thread(
+                    process_image, image_data_url
+                )
 
                 # Remove OpenAI parameter
                 del content["image_url"]
@@ -124,111 +302,274 @@ async def stream_claude_response(
                     "data": base64_data,
                 }
 
-    # Stream Claude response
-    async with client.messages.stream(
-        model=model.value,
-        max_tokens=max_tokens,
-        temperature=temperature,
-        system=system_prompt,
-        messages=claude_messages,  # type: ignore
-        extra_headers={"anthropic-beta": "max-tokens-3-5-sonnet-2024-07-15"},
-    ) as stream:
-        async for text in stream.text_stream:
-            await callback(text)
-
-    # Return final message
-    response = await stream.get_final_message()
-
-    # Close the Anthropic client
-    await client.close()
-
-    return response.content[0].text
+    return system_prompt, claude_messages
 
 
-async def stream_claude_response_native(
-    system_prompt: str,
-    messages: list[Any],
+async def stream_claude_response(
+    messages: List[ChatCompletionMessageParam],
     api_key: str,
     callback: Callable[[str], Awaitable[None]],
-    include_thinking: bool = False,
-    model: Llm = Llm.CLAUDE_3_OPUS,
+    model: Llm,
 ) -> str:
 
-    client = AsyncAnthropic(api_key=api_key)
-
-    # Base model parameters
-    max_tokens = 4096
-    temperature = 0.0
+    client = get_anthropic_client(api_key)
+    try:
+        # Base parameters
+        max_tokens = 8192
+        temperature = 0.0
 
-    # Multi-pass flow
-    current_pass_num = 1
-    max_passes = 2
-
-    prefix = "<thinking>"
-    response = None
-
-    # For debugging
-    full_stream = ""
-    debug_file_writer = DebugFileWriter()
-
-    while current_pass_num <= max_passes:
-        current_pass_num += 1
-
-        # Set up message depending on whether we have a <thinking> prefix
-        messages_to_send = (
-            messages + [{"role": "assistant", "content": prefix}]
-            if include_thinking
-            else messages
-        )
-
-        pprint_prompt(messages_to_send)
+        # Translate OpenAI messages to Claude messages (once, before streaming)
+        system_prompt, claude_messages = await translate_openai_to_claude(messages)
 
+        # Stream Claude response
         async with client.messages.stream(
             model=model.value,
             max_tokens=max_tokens,
             temperature=temperature,
             system=system_prompt,
-            messages=messages_to_send,  # type: ignore
+            messages=claude_messages,  # type: ignore
+            extra_headers={"anthropic-beta": "max-tokens-3-5-sonnet-2024-07-15"},
         ) as stream:
+            coalescer = _CallbackCoalescer(callback)
             async for text in stream.text_stream:
-                print(text, end="", flush=True)
-                full_stream += text
-                await callback(text)
+                await coalescer.add(text)
+            await coalescer.flush()
 
+        # Return final message
         response = await stream.get_final_message()
-        response_text = response.content[0].text
 
-        # Write each pass's code to .html file and thinking to .txt file
-        if IS_DEBUG_ENABLED:
-            debug_file_writer.write_to_file(
-                f"pass_{current_pass_num - 1}.html",
-                debug_file_writer.extract_html_content(response_text),
-            )
-            debug_file_writer.write_to_file(
-                f"thinking_pass_{current_pass_num - 1}.txt",
-                response_text.split("</thinking>")[0],
-            )
+        return response.content[0].text
+    finally:
+        _release_client(client)
 
-        # Set up messages array for next pass
-        messages += [
-            {"role": "assistant", "content": str(prefix) + response.content[0].text},
-            {
-                "role": "user",
-                "content": "You've done a good job with a first draft. Improve this further based on the original instructions so that the app is fully functional and looks like the original video of the app we're trying to replicate.",
-            },
-        ]
 
-        print(
-            f"Token usage: Input Tokens: {response.usage.input_tokens}, Output Tokens: {response.usage.output_tokens}"
-        )
+# Runs one streaming generation pass of the multi-pass native flow.
+# Returns the final message (None if the callback failed mid-stream) plus the
+# thinking/HTML halves of the streamed text (only filled when debugging).
+async def _run_claude_pass(
+    client: AsyncAnthropic,
+    model: Llm,
+    max_tokens: int,
+    temperature: float,
+    system_blocks: list[dict[str, Any]],
+    messages: list[Any],
+    callback: Callable[[str], Awaitable[None]],
+    include_thinking: bool,
+    full_stream_parts: list[str],
+) -> tuple[Any, list[str], list[str]]:
+    thinking_end = "</thinking>"
+
+    # Split thinking from HTML online while streaming, so we don't rescan
+    # the whole response for the </thinking> sentinel after each pass.
+    # `pending` holds the last few chars in case the sentinel spans chunks.
+    thinking_parts: list[str] = []
+    html_parts: list[str] = []
+    in_thinking = include_thinking
+    pending = ""
+    client_gone = False
 
-    # Close the Anthropic client
-    await client.close()
+    async with client.messages.stream(
+        model=model.value,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        system=system_blocks,  # type: ignore
+        messages=messages,  # type: ignore
+        extra_headers={"anthropic-beta": "prompt-caching-2024-07-31"},
+    ) as stream:
+        coalescer = _CallbackCoalescer(callback)
+        async for text in stream.text_stream:
+            # Echoing every token to stdout forces a flush syscall per
+            # token and competes with the event loop — debug only. The
+            # full_stream accumulation is likewise only read when debugging.
+            if IS_DEBUG_ENABLED:
+                print(text, end="", flush=True)
+                full_stream_parts.append(text)
+                if in_thinking:
+                    buffered = pending + text
+                    sentinel_index = buffered.find(thinking_end)
+                    if sentinel_index != -1:
+                        thinking_parts.append(buffered[:sentinel_index])
+                        html_parts.append(
+                            buffered[sentinel_index + len(thinking_end) :]
+                        )
+                        pending = ""
+                        in_thinking = False
+                    elif len(buffered) > len(thinking_end) - 1:
+                        thinking_parts.append(buffered[: -(len(thinking_end) - 1)])
+                        pending = buffered[-(len(thinking_end) - 1) :]
+                    else:
+                        pending = buffered
+                else:
+                    html_parts.append(text)
+            try:
+                await coalescer.add(text)
+            except Exception as exc:
+                # The callback failed — usually because the websocket closed,
+                # but possibly a real bug in the callback, so log the actual
+                # error before stopping this pass
+                traceback.print_exception(type(exc), exc, exc.__traceback__)
+                client_gone = True
+                break
+        if not client_gone:
+            try:
+                await coalescer.flush()
+            except Exception as exc:
+                traceback.print_exception(type(exc), exc, exc.__traceback__)
+                client_gone = True
+
+    if in_thinking:
+        thinking_parts.append(pending)
+
+    if client_gone:
+        return None, thinking_parts, html_parts
+
+    response = await stream.get_final_message()
+    return response, thinking_parts, html_parts
 
-    if IS_DEBUG_ENABLED:
-        debug_file_writer.write_to_file("full_stream.txt", full_stream)
 
-    if not response:
-        raise Exception("No HTML response found in AI response")
-    else:
-        return response.content[0].text
+async def stream_claude_response_native(
+    system_prompt: str,
+    messages: list[Any],
+    api_key: str,
+    callback: Callable[[str], Awaitable[None]],
+    include_thinking: bool = False,
+    model: Llm = Llm.CLAUDE_3_OPUS,
+) -> str:
+
+    client = get_anthropic_client(api_key)
+    try:
+        # Base model parameters
+        max_tokens = 4096
+        temperature = 0.0
+
+        # Multi-pass flow
+        max_passes = 2
+
+        prefix = "<thinking>"
+        response = None
+
+        # For debugging (accumulated as a list to avoid quadratic str
+        # appends). Debug artifacts are written from background threads so
+        # disk I/O overlaps with kicking off the next pass; the tasks are
+        # awaited before returning.
+        full_stream_parts: list[str] = []
+        debug_file_writer = DebugFileWriter()
+        debug_write_tasks: list[asyncio.Task[None]] = []
+
+        # Mark the static prefix (system prompt + the initial user turn with
+        # its images/screenshots) as cacheable so the second pass reuses the
+        # provider-side KV cache instead of re-prefilling the conversation
+        system_blocks = [
+            {
+                "type": "text",
+                "text": system_prompt,
+                "cache_control": {"type": "ephemeral"},
+            }
+        ]
+        if messages and isinstance(messages[0].get("content"), list):
+            messages[0]["content"][-1]["cache_control"] = {"type": "ephemeral"}
+
+        for pass_num in range(1, max_passes + 1):
+            # Add the <thinking> prefix as a trailing assistant message for
+            # this pass only. Append/pop in place rather than
+            # `messages + [...]`, which would copy the whole (multi-MB,
+            # image-laden) list on every pass.
+            if include_thinking:
+                messages.append({"role": "assistant", "content": prefix})
+
+            pprint_prompt(messages)
+
+            try:
+                pass_response, thinking_parts, html_parts = await _run_claude_pass(
+                    client,
+                    model,
+                    max_tokens,
+                    temperature,
+                    system_blocks,
+                    messages,
+                    callback,
+                    include_thinking,
+                    full_stream_parts,
+                )
+            finally:
+                # Remove the prefix message again before extending the
+                # conversation — even when the pass raises (rate limit, auth
+                # error), so the caller's list isn't left with a dangling
+                # assistant prefill
+                if include_thinking:
+                    messages.pop()
+
+            # The callback failed (e.g. the websocket closed), so there is no
+            # one listening — don't burn an extra generation nobody will see
+            if pass_response is None:
+                print("Streaming callback failed - skipping remaining passes")
+                break
+
+            response = pass_response
+
+            # Write each pass's code to .html file and thinking to .txt file
+            if IS_DEBUG_ENABLED:
+                debug_write_tasks.append(
+                    asyncio.create_task(
+                        asyncio.to_thread(
+                            debug_file_writer.write_to_file,
+                            f"pass_{pass_num}.html",
+                            debug_file_writer.extract_html_content(
+                                "".join(html_parts)
+                            ),
+                        )
+                    )
+                )
+                debug_write_tasks.append(
+                    asyncio.create_task(
+                        asyncio.to_thread(
+                            debug_file_writer.write_to_file,
+                            f"thinking_pass_{pass_num}.txt",
+                            "".join(thinking_parts),
+                        )
+                    )
+                )
+
+            # Set up messages array for next pass. The conversation is
+            # strictly append-only, and the pass's reply is sent as a
+            # cache-tagged content block so the next pass reuses the provider
+            # KV cache for the entire prefix (system + images + this reply).
+            messages += [
+                {
+                    "role": "assistant",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": str(prefix) + response.content[0].text,
+                            "cache_control": {"type": "ephemeral"},
+                        }
+                    ],
+                },
+                {
+                    "role": "user",
+                    "content": "You've done a good job with a first draft. Improve this further based on the original instructions so that the app is fully functional and looks like the original video of the app we're trying to replicate.",
+                },
+            ]
+
+            print(
+                f"Token usage: Input Tokens: {response.usage.input_tokens}, Output Tokens: {response.usage.output_tokens}"
+            )
+
+        if IS_DEBUG_ENABLED:
+            debug_write_tasks.append(
+                asyncio.create_task(
+                    asyncio.to_thread(
+                        debug_file_writer.write_to_file,
+                        "full_stream.txt",
+                        "".join(full_stream_parts),
+                    )
+                )
+            )
+            await asyncio.gather(*debug_write_tasks)
+
+        if not response:
+            raise Exception("No HTML response found in AI response")
+        else:
+            return response.content[0].text
+    finally:
+        _release_client(client)
@@ -6,6 +6,7 @@ load_dotenv()
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from llm import close_all_clients
 from routes import screenshot, generate_code, home, evals
 
 app = FastAPI(openapi_url=None, docs_url=None, redoc_url=None)
@@ -24,3 +25,9 @@ app.include_router(generate_code.router)
 app.include_router(screenshot.router)
 app.include_router(home.router)
 app.include_router(evals.router)
+
+
+# Close the pooled LLM clients when the server shuts down
+@app.on_event("shutdown")
+async def close_llm_clients():
+    await close_all_clients()
@@ -1,5 +1,9 @@
+import asyncio
 import unittest
-from llm import convert_frontend_str_to_llm, Llm
+from llm import convert_frontend_str_to_llm, translate_openai_to_claude, Llm
+
+# 1x1 transparent PNG
+TINY_PNG_DATA_URL = "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
 
 
 class TestConvertFrontendStrToLlm(unittest.TestCase):
@@ -37,5 +41,55 @@ class TestConvertFrontendStrToLlm(unittest.TestCase):
             convert_frontend_str_to_llm("another_invalid_string")
 
 
+class TestTranslateOpenAIToClaude(unittest.TestCase):
+    def test_translates_system_prompt_and_images(self):
+        messages = [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": TINY_PNG_DATA_URL, "detail": "high"},
+                    },
+                    {"type": "text", "text": "Turn this into code."},
+                ],
+            },
+        ]
+
+        system_prompt, claude_messages = asyncio.run(
+            translate_openai_to_claude(messages)  # type: ignore
+        )
+
+        self.assertEqual(system_prompt, "You are a helpful assistant.")
+        self.assertEqual(len(claude_messages), 1)
+
+        image_block = claude_messages[0]["content"][0]
+        self.assertEqual(image_block["type"], "image")
+        self.assertNotIn("image_url", image_block)
+        self.assertEqual(image_block["source"]["type"], "base64")
+        self.assertEqual(image_block["source"]["media_type"], "image/png")
+
+        # The original messages should be untouched
+        self.assertEqual(messages[1]["content"][0]["type"], "image_url")
+
+    def test_translation_is_cached_per_message_list(self):
+        messages = [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image_url", "image_url": {"url": TINY_PNG_DATA_URL}},
+                ],
+            },
+        ]
+
+        first = asyncio.run(translate_openai_to_claude(messages))  # type: ignore
+        second = asyncio.run(translate_openai_to_claude(messages))  # type: ignore
+
+        # Repeat calls with the same list reuse the translated messages
+        self.assertIs(first[1], second[1])
+
+
 if __name__ == "__main__":
     unittest.main()
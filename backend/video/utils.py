@@ -10,6 +10,8 @@ from moviepy.editor import VideoFileClip  # type: ignore
 from PIL import Image
 import math
 
+from image_processing.utils import DATA_URL_REGEX
+
 
 DEBUG = True
 TARGET_NUM_SCREENSHOTS = (
@@ -66,10 +68,14 @@ def split_video_into_screenshots(video_data_url: str) -> list[Image.Image]:
     target_num_screenshots = TARGET_NUM_SCREENSHOTS
 
     # Decode the base64 URL to get the video bytes
-    video_encoded_data = video_data_url.split(",")[1]
+    # (one prefix match + tail slice instead of three full-payload splits)
+    match = DATA_URL_REGEX.match(video_data_url)
+    if not match:
+        raise ValueError("Invalid base64 data URL")
+    video_encoded_data = video_data_url[match.end() :]
     video_bytes = base64.b64decode(video_encoded_data)
 
-    mime_type = video_data_url.split(";")[0].split(":")[1]
+    mime_type = match.group(1)
     suffix = mimetypes.guess_extension(mime_type)
 
     with tempfile.NamedTemporaryFile(suffix=suffix, delete=True) as temp_video_file: